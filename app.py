@@ -1,103 +1,335 @@
 import streamlit as st
 import tempfile
 import os
-from moviepy.editor import VideoFileClip, AudioFileClip, ImageClip, CompositeVideoClip
+import functools
+import hashlib
+import subprocess
+import contextlib
+from pathlib import Path
+import ffmpeg
 
 # --- Default Files ---
 DEFAULT_OVERLAY_VIDEO = "greenscreen_overlay.mp4"  # Pre-generated video
+OUTPUT_FPS = 24
+BACKGROUND_HEIGHT = 720
+CHROMA_KEY_COLOR = "0x00ff00"
+CHROMA_KEY_SIMILARITY = 0.39
+MP4_AUDIO_CODECS = ("aac", "mp3")  # Can be stream-copied into the MP4 as-is
 
-# Get audio duration using mutagen (pure Python)
-def get_audio_duration(audio_path):
+# --- App Cache ---
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "brainrotvideomaker")
+PREPARED_OVERLAY_OPTIONS = {
+    # NVDEC cannot decode ffv1, so keep a near-lossless H.264 copy for the CUDA path
+    "cuda": {"vcodec": "h264_nvenc", "rc": "constqp", "qp": 0, "pix_fmt": "nv12"},
+    "cpu": {"vcodec": "ffv1", "pix_fmt": "yuv420p"},
+}
+RENDER_DIR = os.path.join(CACHE_DIR, "renders")
+MAX_RENDERS = 32  # Matches the process_media cache size; older files are pruned
+RENDER_VERSION = 1  # Bump when the filtergraph changes so persisted renders are not reused
+
+# --- FFmpeg ---
+FFMPEG_LOG_ARGS = ("-hide_banner", "-loglevel", "error", "-nostats")  # Errors only, no progress lines
+
+# --- Encoders ---
+HW_ENCODERS = ("h264_nvenc", "h264_vaapi", "h264_qsv")  # In order of preference
+VAAPI_DEVICE = "/dev/dri/renderD128"
+PROBE_TIMEOUT = 10  # Seconds; a hung driver or device node counts as "not available"
+CUDA_FILTERS = ("chromakey_cuda", "overlay_cuda")
+VAAPI_FILTERS = ("overlay_vaapi",)
+ENCODER_OPTIONS = {
+    "h264_nvenc": {"preset": "p4"},  # Accepts yuv420p or CUDA frames as-is
+    "h264_vaapi": {},  # Frames are uploaded as nv12 in the filtergraph
+    "h264_qsv": {"preset": "veryfast", "pix_fmt": "nv12"},
+    "libx264": {
+        "preset": "ultrafast", "tune": "zerolatency", "crf": 28, "pix_fmt": "yuv420p",
+    },
+}
+
+# Check that an encoder actually works (listed encoders may lack a device/driver)
+def encoder_works(codec):
+    args = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    video_filter = "format=yuv420p"
+    if codec == "h264_vaapi":
+        args += ["-vaapi_device", VAAPI_DEVICE]
+        video_filter = "format=nv12,hwupload"
+    args += [
+        "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+        "-vf", video_filter, "-c:v", codec, "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(args, capture_output=True, timeout=PROBE_TIMEOUT).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+# Pick the fastest available H.264 encoder (probed once per process)
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=PROBE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return "libx264"
+    for codec in HW_ENCODERS:
+        if codec in result.stdout and encoder_works(codec):
+            return codec
+    return "libx264"
+
+# Check whether this ffmpeg build has the given (GPU) filters
+@functools.lru_cache(maxsize=None)
+def filters_available(*names):
     try:
-        from mutagen.mp3 import MP3
-        from mutagen.wave import WAVE
-        from mutagen.aac import AAC
-        from mutagen.oggvorbis import OggVorbis
-
-        ext = os.path.splitext(audio_path)[1].lower()
-        if ext == ".mp3":
-            audio = MP3(audio_path)
-        elif ext == ".wav":
-            audio = WAVE(audio_path)
-        elif ext == ".aac":
-            audio = AAC(audio_path)
-        elif ext == ".ogg":
-            audio = OggVorbis(audio_path)
-        else:
-            st.error(f"Unsupported audio format: {ext}")
-            return 0
-        return audio.info.length
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-filters"], capture_output=True, text=True, timeout=PROBE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return all(f" {name} " in result.stdout for name in names)
+
+# Content hash of the source overlay video (read once per process)
+@functools.lru_cache(maxsize=None)
+def overlay_source_digest():
+    with open(DEFAULT_OVERLAY_VIDEO, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+# Location of the prepared overlay; the name changes whenever the source or preparation settings do
+def prepared_overlay_path(gpu=False):
+    kind = "cuda" if gpu else "cpu"
+    settings = repr((overlay_source_digest(), OUTPUT_FPS, PREPARED_OVERLAY_OPTIONS[kind]))
+    fingerprint = hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+    return os.path.join(CACHE_DIR, f"overlay_{kind}_{fingerprint}.mkv")
+
+# Convert the overlay once to the output frame rate and pixel format; reused across renders and restarts
+@st.cache_resource
+def prepared_overlay(gpu=False):
+    path = prepared_overlay_path(gpu)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    partial_path = os.path.splitext(path)[0] + ".partial.mkv"
+    # Drop to the output frame rate first so no later filter sees surplus frames
+    # (the source is already 1280x720, so no scaling is needed)
+    stream = ffmpeg.input(DEFAULT_OVERLAY_VIDEO).video.filter("fps", OUTPUT_FPS)
+    try:
+        (
+            ffmpeg.output(stream, partial_path, **PREPARED_OVERLAY_OPTIONS["cuda" if gpu else "cpu"])
+            .global_args(*FFMPEG_LOG_ARGS)
+            .run(capture_stdout=True, capture_stderr=True, overwrite_output=True)
+        )
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, path)  # Only complete files ever appear under the final name
+
+    # Remove copies prepared from an older source or with older settings
+    prefix = os.path.basename(path).rsplit("_", 1)[0] + "_"
+    for name in os.listdir(CACHE_DIR):
+        stale = name.startswith(prefix) and name.endswith(".mkv") and ".partial" not in name
+        if stale and name != os.path.basename(path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(CACHE_DIR, name))
+    return path
+
+# Prepare the overlay once per server process; returns the error message on failure so
+# a failed attempt is remembered instead of retried on every rerun
+@st.cache_resource(show_spinner=False)
+def prepare_overlay_at_startup():
+    try:
+        prepared_overlay(use_cuda_path(detect_hw_encoder()))
+    except ffmpeg.Error as e:
+        return e.stderr.decode(errors="replace")
     except Exception as e:
-        st.error(f"Could not determine audio duration: {e}")
-        return 0
+        return str(e)
+    return None
 
-# Process media and create final video
-def process_media(audio_file, image_file):
+# Whether the prepared overlay for the current encoder exists on disk (a render may have built it since startup)
+def overlay_ready():
     try:
-        # Save uploaded files
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio_file.name)[1]) as tmp_audio:
-            tmp_audio.write(audio_file.read())
-            audio_path = tmp_audio.name
+        return os.path.exists(prepared_overlay_path(use_cuda_path(detect_hw_encoder())))
+    except OSError:
+        return False
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(image_file.name)[1]) as tmp_image:
-            tmp_image.write(image_file.read())
-            image_path = tmp_image.name
+# Whether keying and compositing can run on the GPU for this encoder
+def use_cuda_path(codec):
+    return codec == "h264_nvenc" and filters_available(*CUDA_FILTERS)
 
-        # Get audio duration
-        duration = get_audio_duration(audio_path)
-        if duration <= 0:
-            st.error("Audio duration is invalid.")
-            return None
+# Composite the keyed overlay on top of the image (read from stdin)
+def composite_video(codec):
+    image = ffmpeg.input("pipe:0", f="image2pipe", framerate=OUTPUT_FPS)
+    # Scale (and upload) the single decoded frame once, then repeat it; nothing re-encodes the still
+    still = image.video.filter("scale", -2, BACKGROUND_HEIGHT)
 
-        # Load video and prepare overlay
-        overlay_clip = VideoFileClip(DEFAULT_OVERLAY_VIDEO)
-        overlay_clip_resized = overlay_clip.resize(width=1280)  # Adjust size to fit the image
-        overlay_clip_resized = overlay_clip_resized.set_duration(duration)  # Match duration to the audio
+    if use_cuda_path(codec):
+        # Decoded overlay frames stay in GPU memory through keying, compositing and encoding
+        overlay = ffmpeg.input(
+            prepared_overlay(True),
+            stream_loop=-1, hwaccel="cuda", hwaccel_output_format="cuda",
+        )
+        keyed_overlay = overlay.video.filter("chromakey_cuda", CHROMA_KEY_COLOR, CHROMA_KEY_SIMILARITY, 0.0)
+        background = (
+            still
+            .filter("format", "yuv420p")
+            .filter("hwupload_cuda")
+            .filter("loop", loop=-1, size=1)
+        )
+        return ffmpeg.filter([background, keyed_overlay], "overlay_cuda", shortest=1)
 
-        # Load the image
-        image_clip = ImageClip(image_path).set_duration(duration).resize(height=720).set_position('center')
+    background = still.filter("loop", loop=-1, size=1)
+    overlay = ffmpeg.input(prepared_overlay(), stream_loop=-1)
+    keyed_overlay = overlay.video.filter("chromakey", CHROMA_KEY_COLOR, CHROMA_KEY_SIMILARITY, 0.0)
+    if codec == "h264_vaapi":
+        if filters_available(*VAAPI_FILTERS):
+            # No VAAPI chroma key, but the compositing itself can run on the GPU
+            background = still.filter("format", "nv12").filter("hwupload").filter("loop", loop=-1, size=1)
+            keyed_overlay = keyed_overlay.filter("format", "bgra").filter("hwupload")
+            return ffmpeg.filter([background, keyed_overlay], "overlay_vaapi", shortest=1)
+        video = ffmpeg.overlay(background, keyed_overlay, shortest=1)
+        return video.filter("format", "nv12").filter("hwupload")
+    return ffmpeg.overlay(background, keyed_overlay, shortest=1)
 
-        # Combine image and overlay video
-        final_video = CompositeVideoClip([image_clip, overlay_clip_resized])
+# Probe audio metadata with ffprobe (cached per file path and modification time)
+@functools.lru_cache(maxsize=64)
+def probe_audio(audio_path, mtime):
+    return ffmpeg.probe(audio_path)
 
-        # Add audio
-        audio = AudioFileClip(audio_path).subclip(0, duration)  # Trim audio to match video
-        final_video = final_video.set_audio(audio)
+# Get audio duration using ffprobe (0 if the container reports none); ffprobe errors propagate
+def get_audio_duration(audio_path):
+    info = probe_audio(audio_path, os.path.getmtime(audio_path))
+    return float(info["format"].get("duration", 0))
+
+# Pick the output audio codec: stream-copy when the MP4 can hold the source as-is
+def audio_codec_for(audio_path):
+    info = probe_audio(audio_path, os.path.getmtime(audio_path))
+    codecs = [stream["codec_name"] for stream in info["streams"] if stream["codec_type"] == "audio"]
+    return "copy" if codecs and codecs[0] in MP4_AUDIO_CODECS else "aac"
+
+# Modification time of a render, or 0 if another session already pruned it
+def render_mtime(path):
+    with contextlib.suppress(FileNotFoundError):
+        return os.path.getmtime(path)
+    return 0
+
+# Delete all but the MAX_RENDERS most recently used rendered videos
+def prune_renders():
+    renders = [
+        os.path.join(RENDER_DIR, name) for name in os.listdir(RENDER_DIR)
+        if name.startswith("final_output_") and name.endswith(".mp4")
+    ]
+    renders.sort(key=render_mtime, reverse=True)
+    for path in renders[MAX_RENDERS:]:
+        with contextlib.suppress(FileNotFoundError):  # Another render may be pruning concurrently
+            os.remove(path)
+
+# Fingerprint of every setting besides the uploads that affects a render; part of the cache key
+def render_settings():
+    codec = detect_hw_encoder()
+    gpu = use_cuda_path(codec)
+    settings = (
+        RENDER_VERSION, codec, ENCODER_OPTIONS[codec], gpu, filters_available(*VAAPI_FILTERS),
+        CHROMA_KEY_COLOR, CHROMA_KEY_SIMILARITY, OUTPUT_FPS, BACKGROUND_HEIGHT, MP4_AUDIO_CODECS,
+        os.path.basename(prepared_overlay_path(gpu)),
+    )
+    return hashlib.blake2b(repr(settings).encode(), digest_size=8).hexdigest()
 
-        # Save the final video
-        final_output_path = os.path.join(tempfile.gettempdir(), "final_output.mp4")
-        final_video.write_videofile(final_output_path, codec="libx264", audio_codec="aac", fps=24)
+# Process media and create final video (memoised on upload contents and render settings, kept across restarts)
+@st.cache_data(show_spinner=False, max_entries=MAX_RENDERS, persist="disk")
+def process_media(audio_bytes, audio_ext, image_bytes, settings):
+    # Save uploaded audio (the image is piped straight into ffmpeg)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=audio_ext) as tmp_audio:
+        tmp_audio.write(audio_bytes)
+        audio_path = tmp_audio.name
+
+    try:
+        # Get audio duration
+        duration = get_audio_duration(audio_path)
+        if duration <= 0:
+            raise ValueError("Audio duration is invalid.")
 
+        # Build a single filtergraph: image background, keyed overlay on top
+        codec = detect_hw_encoder()
+        video = composite_video(codec)
+        acodec = audio_codec_for(audio_path)
+        audio_options = {"fflags": "+genpts"} if acodec == "copy" else {}
+        audio = ffmpeg.input(audio_path, t=duration, **audio_options)  # Trim audio to match video
+
+        # Encode video and mux audio in one pass, named after the inputs so renders never collide
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (settings.encode(), audio_ext.encode(), audio_bytes, image_bytes):
+            digest.update(len(part).to_bytes(8, "big"))  # Length prefix keeps part boundaries unambiguous
+            digest.update(part)
+        os.makedirs(RENDER_DIR, exist_ok=True)
+        final_output_path = os.path.join(RENDER_DIR, f"final_output_{digest.hexdigest()}.mp4")
+        output = ffmpeg.output(
+            video, audio.audio, final_output_path,
+            vcodec=codec, acodec=acodec, r=OUTPUT_FPS,
+            t=duration, shortest=None, movflags="+faststart",
+            **ENCODER_OPTIONS[codec],
+        )
+        output = output.global_args(*FFMPEG_LOG_ARGS)
+        if codec == "h264_vaapi":
+            output = output.global_args("-vaapi_device", VAAPI_DEVICE)
+        output.run(input=image_bytes, capture_stdout=True, capture_stderr=True, overwrite_output=True)
+
+        prune_renders()
+        return final_output_path
+    finally:
         # Cleanup
         os.remove(audio_path)
-        os.remove(image_path)
 
-        return final_output_path
+# Create the final video for the uploaded files, reporting any errors in the UI
+def create_video(audio_file, image_file):
+    try:
+        args = (audio_file.getvalue(), os.path.splitext(audio_file.name)[1], image_file.getvalue(), render_settings())
+        final_video_path = process_media(*args)
+        try:
+            os.utime(final_video_path)  # Mark as recently used so pruning keeps popular renders
+        except FileNotFoundError:
+            # The cached render was pruned or deleted from disk, so render again
+            process_media.clear(*args)
+            final_video_path = process_media(*args)
+        return final_video_path
 
+    except ffmpeg.Error as e:
+        st.error(f"FFmpeg failed: {e.stderr.decode(errors='replace')}")
+        return None
     except Exception as e:
         st.error(f"An error occurred: {e}")
         return None
 
+# Read a finished render for download (runs when the button is clicked, not when the page renders)
+def read_render(path):
+    try:
+        return Path(path).read_bytes()
+    except FileNotFoundError:
+        # Streamlit shows this message to the user in place of the download
+        raise FileNotFoundError("This video was removed from the server cache. Re-upload your files to render it again.") from None
+
 # --- Streamlit UI ---
 st.title("🎬 Media Fusion Studio")
 st.write("Upload your audio and image to create a video with a greenscreen overlay!")
 
+# Prepare the overlay at startup rather than during the first render
+with st.spinner("Preparing the overlay video..."):
+    overlay_error = prepare_overlay_at_startup()
+if overlay_error and not overlay_ready():
+    st.sidebar.warning(f"Could not prepare the overlay video: {overlay_error}")
+
 uploaded_audio = st.file_uploader("Upload your audio file (MP3, WAV, AAC, OGG)", type=["mp3", "wav", "aac", "ogg"])
 uploaded_image = st.file_uploader("Upload your image file (PNG, JPG, etc.)", type=["png", "jpg", "jpeg"])
 
 if uploaded_audio and uploaded_image:
     st.info("Processing your media... please wait ⏳")
-    final_video_path = process_media(uploaded_audio, uploaded_image)
+    final_video_path = create_video(uploaded_audio, uploaded_image)
 
     if final_video_path:
-        with open(final_video_path, "rb") as f:
-            st.download_button(
-                label="⬇️ Download Final Video",
-                data=f.read(),
-                file_name="final_video.mp4",
-                mime="video/mp4"
-            )
-        os.remove(final_video_path)
+        st.download_button(
+            label="⬇️ Download Final Video",
+            data=functools.partial(read_render, final_video_path),  # Only read from disk when clicked
+            file_name="final_video.mp4",
+            mime="video/mp4"
+        )
     else:
         st.error("Failed to generate the video. Please try again.")
 